@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import collections
 import fnmatch
-import heapq
+import functools
 import os
+import queue
+import re
 import shutil
 import subprocess
 import sys
@@ -13,34 +16,81 @@ import tty
 
 from datetime import datetime
 
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
 
-ISO_8601 = '%Y-%m-%dT%H:%M:%S.%f'
+
+LOG_BATCH = 64
+
+STATUS_START = b'\x1b[1;32m'
+STATUS_END = b'\x1b[0m\n'
+
+RESCAN_INTERVAL = 10 * 60
+
+# workers only wait for their subprocess, the default 8 MiB stack is wasted on them
+WORKER_STACK_SIZE = 256 * 1024
 
 
 class LogParseError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=1)
+def _finish_times(started, avg_time):
+    # the running jobs rarely change between status updates
+    return tuple(sorted(map(lambda t: t + avg_time, started)))
+
+
+class _Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.job = None
+
+
 class Runner:
-    def __init__(self, cmd_path, jobs_dir, pattern, log_path):
+    def __init__(self, cmd_path, jobs_dir, pattern, log_path, server=False, poll=False):
         self._cmd = cmd_path
+        self._server = server
+        self._poll = poll or watchfiles is None
         self._jobs_dir = jobs_dir
-        self._pattern = pattern
+        if pattern == '*':
+            self._match = lambda fname: True
+        elif not any(c in pattern for c in '*?['):
+            self._match = pattern.__eq__
+        else:
+            self._match = re.compile(fnmatch.translate(pattern)).match
         self._log = open(log_path, 'a')
+        self._log_q = queue.SimpleQueue()
 
-        self._jobs = set()
+        # jobs in FIFO order; names removed from _jobs_set are skipped lazily
+        self._jobs = collections.deque()
+        self._jobs_set = set()
         self._done = {}
+        self._done_sum = 0
         self._started = {}
 
         self._lock = threading.Lock()
-        self._waiting = threading.Condition(self._lock)
+        # idle workers, each woken with the job it was handed
+        self._idle = collections.deque()
+
+        # (njobs, ndone, nrunning, done_sum) for the status line, so that
+        # reading it does not hold up the workers
+        self._counters = (0, 0, 0, 0)
+        self._counters_lock = threading.Lock()
 
         self._nworkers = 0
         self._mtime = 0
+        self._stop = threading.Event()
 
 
     def start(self):
-        threading.Thread(target=self._update_loop, daemon=True).start()
+        log_thread = threading.Thread(target=self._log_loop, daemon=True)
+        log_thread.start()
+        update_thread = threading.Thread(target=self._update_loop, daemon=True)
+        update_thread.start()
+        threading.Thread(target=self._status_loop, daemon=True).start()
 
         old = termios.tcgetattr(sys.stdin)
         try:
@@ -50,6 +100,10 @@ class Runner:
             pass
         finally:
             termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, old)
+            self._stop.set()
+            update_thread.join()
+            self._log_q.put(None)
+            log_thread.join()
 
 
     def load_log(self, path=None):
@@ -60,8 +114,11 @@ class Runner:
             done = {}
             for i, line in enumerate(f):
                 try:
-                    ts, event, job = line.rstrip().split(' ')
-                    ts = datetime.strptime(ts, ISO_8601).timestamp()
+                    ts, _, rest = line.rstrip().partition(' ')
+                    event, _, job = rest.partition(' ')
+                    if not job:
+                        raise ValueError
+                    ts = datetime.fromisoformat(ts).timestamp()
                 except:
                     raise LogParseError('{}: invalid line {}'.format(f.name, i+1))
                 if event == 'started':
@@ -70,14 +127,33 @@ class Runner:
                     done[job] = ts - started.pop(job)
         with self._lock:
             self._done = done
+            self._done_sum = sum(done.values())
+            self._update_counters()
 
 
     def _log_write(self, ts, event, job):
-        ts = ts.strftime(ISO_8601)
-        print('{} {} {}'.format(ts, event, job), file=self._log, flush=True)
+        self._log_q.put((ts, event, job))
+
+
+    def _log_loop(self):
+        while True:
+            item = self._log_q.get()
+            lines = []
+            while item is not None:
+                ts, event, job = item
+                lines.append('{} {} {}\n'.format(ts.isoformat(timespec='microseconds'), event, job))
+                if len(lines) == LOG_BATCH or self._log_q.empty():
+                    break
+                item = self._log_q.get_nowait()
+            self._log.write(''.join(lines))
+            self._log.flush()
+            if item is None:
+                return
 
 
     def _control_loop(self):
+        # only worker threads are started from here on
+        threading.stack_size(WORKER_STACK_SIZE)
         running = 0
         while True:
             c = sys.stdin.read(1)
@@ -94,84 +170,186 @@ class Runner:
 
 
     def _update_loop(self):
+        if self._poll:
+            self._poll_loop()
+            return
+
+        # the first full rescan waits for the first yield, when the watcher
+        # is already live, so no file created in between is missed; later
+        # ones catch changes the watcher might have missed
+        last_rescan = None
+        try:
+            for changes in watchfiles.watch(self._jobs_dir, watch_filter=None, recursive=False,
+                                            rust_timeout=1000, yield_on_timeout=True,
+                                            stop_event=self._stop):
+                self._process_changes(changes)
+                if last_rescan is None or time.monotonic() - last_rescan >= RESCAN_INTERVAL:
+                    self._rescan_jobs()
+                    last_rescan = time.monotonic()
+        except OSError as e:
+            # e.g. the limit on watched files is reached
+            print('{}: cannot watch {} ({}), polling it instead'.format(sys.argv[0], self._jobs_dir, e),
+                  file=sys.stderr)
+            self._poll_loop()
+
+
+    def _poll_loop(self):
+        while True:
+            mtime = os.stat(self._jobs_dir).st_mtime_ns
+            if self._mtime != mtime:
+                self._mtime = mtime
+                self._rescan_jobs()
+            if self._stop.wait(1):
+                return
+
+
+    def _status_loop(self):
+        last_state = None
         last_status = None
         while True:
-            self._update_jobs()
-            status = self._status_line()
-            if status != last_status:
-                print('\x1b[1;32m{:%H:%M:%S}\t{}\x1b[0m'.format(datetime.now(), status))
-                last_status = status
+            with self._counters_lock:
+                state = self._counters
+            state += (self._nworkers,)
+            # eta only counts down while jobs of known duration are running
+            ndone, nrunning = state[1:3]
+            if state != last_state or ndone and nrunning:
+                status = self._status_line(*state)
+                if status != last_status:
+                    # a single write is not interleaved with the output of the jobs
+                    line = time.strftime('%H:%M:%S') + '\t' + status
+                    os.write(1, STATUS_START + line.encode() + STATUS_END)
+                    last_status = status
+                last_state = state
             time.sleep(1)
 
 
     def _worker(self):
+        server = None
         while True:
             job = self._job_get()
-            argv = [self._cmd, os.path.join(self._jobs_dir, job)]
-            returncode = subprocess.call(argv, stdout=sys.stdout, stderr=sys.stdout)
+            path = os.path.join(self._jobs_dir, job)
+            if self._server:
+                server, returncode = self._server_call(server, path)
+            else:
+                returncode = subprocess.call([self._cmd, path], stdout=1, stderr=1)
             if returncode == 0:
                 self._job_done(job)
             else:
                 self._job_retry(job)
 
 
+    def _server_call(self, server, path):
+        # the server reads job paths from stdin and answers each with its
+        # exit status on stdout; anything else it prints goes to stderr
+        if server is None:
+            server = subprocess.Popen([self._cmd, '--server'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=1, text=True)
+        try:
+            server.stdin.write(path + '\n')
+            server.stdin.flush()
+            return server, int(server.stdout.readline())
+        except (OSError, ValueError):
+            # a server that died or broke the protocol is restarted for the next job
+            server.kill()
+            server.wait()
+            return None, -1
+
+
     def _job_get(self):
         with self._lock:
-            while not self._can_start():
-                self._waiting.wait()
-            job = self._jobs.pop()
-            ts = datetime.now()
-            self._started[job] = ts.timestamp()
-            self._log_write(ts, 'started', job)
-            return job
+            if self._can_start():
+                job = self._job_take()
+            else:
+                waiter = _Waiter()
+                self._idle.append(waiter)
+                job = None
+        if job is None:
+            waiter.event.wait()
+            job = waiter.job
+        self._log_write(datetime.now(), 'started', job)
+        return job
+
+
+    def _job_take(self):
+        job = self._jobs.popleft()
+        while job not in self._jobs_set:
+            job = self._jobs.popleft()
+        self._jobs_set.remove(job)
+        self._started[job] = time.monotonic()
+        self._update_counters()
+        return job
 
 
     def _job_done(self, job):
-        ts = datetime.now()
+        now = time.monotonic()
+        self._log_write(datetime.now(), 'done', job)
         with self._lock:
-            self._log_write(ts, 'done', job)
-            self._done[job] = ts.timestamp() - self._started.pop(job)
+            elapsed = now - self._started.pop(job)
+            self._done[job] = elapsed
+            self._done_sum += elapsed
+            self._update_counters()
             self._notify_some_waiting()
 
 
     def _job_retry(self, job):
-        ts = datetime.now()
+        self._log_write(datetime.now(), 'failed', job)
         with self._lock:
-            self._log_write(ts, 'failed', job)
             self._started.pop(job)
-            self._jobs.add(job)
+            self._jobs.append(job)
+            self._jobs_set.add(job)
+            self._update_counters()
             self._notify_some_waiting()
 
 
-    def _update_jobs(self):
-        mtime = os.stat(self._jobs_dir).st_mtime
-        if self._mtime == mtime:
-            return
-        self._mtime = mtime
-
-        files = []
-        for fname in os.listdir(self._jobs_dir):
-            if not fname.startswith('.') and fnmatch.fnmatch(fname, self._pattern):
-                files.append(fname)
+    def _rescan_jobs(self):
+        with os.scandir(self._jobs_dir) as it:
+            files = {e.name for e in it if not e.name.startswith('.') and self._match(e.name)}
 
         with self._lock:
-            jobs = set()
-            for job in files:
-                if job not in self._done and job not in self._started:
-                    jobs.add(job)
-            self._jobs = jobs
-            self._notify_some_waiting()
+            self._update_jobs(files, self._jobs_set - files)
+
+
+    def _process_changes(self, changes):
+        names = set()
+        for change, path in changes:
+            if change == watchfiles.Change.modified:
+                continue
+            fname = os.path.basename(path)
+            if not fname.startswith('.') and self._match(fname):
+                names.add(fname)
+        if not names:
+            return
 
+        # added and deleted events for the same file may come in one batch
+        added = set(filter(lambda f: os.path.lexists(os.path.join(self._jobs_dir, f)), names))
+        removed = names - added
 
-    def _status_line(self):
         with self._lock:
-            njobs = len(self._jobs)
-            ndone = len(self._done)
-            avg_time = sum(self._done.values()) / ndone if ndone else None
-            started = list(self._started.values())
-        nworkers = self._nworkers
+            self._update_jobs(added, removed)
+
+
+    def _update_jobs(self, added, removed):
+        # only the new names get sorted, not every file seen by a rescan
+        new = [job for job in added
+               if job not in self._done and job not in self._started and job not in self._jobs_set]
+        for job in sorted(new):
+            self._jobs.append(job)
+            self._jobs_set.add(job)
+        self._jobs_set -= removed
+        if len(self._jobs) > 2 * len(self._jobs_set):
+            self._jobs = collections.deque(dict.fromkeys(filter(self._jobs_set.__contains__, self._jobs)))
+        self._update_counters()
+        self._notify_some_waiting()
+
+
+    def _status_line(self, njobs, ndone, nrunning, done_sum, nworkers):
+        avg_time = done_sum / ndone if ndone else None
+        started = ()
+        if avg_time and nrunning:
+            with self._lock:
+                started = tuple(self._started.values())
         eta = self._eta(nworkers, njobs, started, avg_time)
-        return self._fmt_status(len(started), nworkers, njobs + len(started), ndone, eta)
+        return self._fmt_status(nrunning, nworkers, njobs + nrunning, ndone, eta)
 
 
     def _fmt_status(self, nrunning, nworkers, njobs, ndone, eta):
@@ -185,61 +363,73 @@ class Runner:
     def _eta(self, nworkers, njobs, started, avg_time):
         if not avg_time:
             return '?'
+        now = time.monotonic()
+        finish = _finish_times(started, avg_time)
         if not njobs:
-            if not started:
+            if not finish:
                 return '0'
-            return self._fmt_eta(max(started) + avg_time)
+            return self._fmt_eta(finish[-1] - now)
         if not nworkers:
             return '\u221e'
 
-        finish = list(map(lambda t: t + avg_time, started))
-        heapq.heapify(finish)
-
-        while len(finish) > nworkers:
-            heapq.heappop(finish)
-        while len(finish) < nworkers:
-            heapq.heappush(finish, datetime.now().timestamp())
-
-        while njobs:
-            if njobs >= nworkers and max(finish) - finish[0] < avg_time:
-                k = njobs // nworkers
-                finish = list(map(lambda t: t + k*avg_time, finish))
-                njobs %= nworkers
-            else:
-                heapq.heapreplace(finish, finish[0] + avg_time)
-                njobs -= 1
-
-        return self._fmt_eta(max(finish))
+        # the nworkers running jobs that finish last keep going (after a '-'
+        # the workers finishing first stop), idle slots are free now and
+        # overdue jobs are taken as finishing now, so all are within avg_time
+        # of each other and the remaining jobs go round-robin in order of
+        # finish time; only the worker taking the last job matters
+        k, r = divmod(njobs, nworkers)
+        i = len(finish) - nworkers + (r - 1 if r else nworkers - 1)
+        free = max(finish[i] - now, 0) if i >= 0 else 0
+        return self._fmt_eta(free + (k + bool(r))*avg_time)
 
 
     def _fmt_eta(self, eta):
-        sec = int(eta - datetime.now().timestamp())
+        sec = int(eta)
         if sec <= 0:
             return '0'
-        s = '{}s'.format(sec % 60)
-        if 60 <= sec:
-            s = '{}m '.format(sec // 60 % 60) + s
-        if 60*60 <= sec:
-            s = '{}h '.format(sec // 60 // 60) + s
-        return s
+        h, sec = divmod(sec, 60*60)
+        m, sec = divmod(sec, 60)
+        if h:
+            return f'{h}h {m}m {sec}s'
+        if m:
+            return f'{m}m {sec}s'
+        return f'{sec}s'
 
 
     def _can_start(self):
-        return max(0, min(len(self._jobs), self._nworkers - len(self._started)))
+        return max(0, min(len(self._jobs_set), self._nworkers - len(self._started)))
+
+
+    def _update_counters(self):
+        counters = (len(self._jobs_set), len(self._done), len(self._started), self._done_sum)
+        with self._counters_lock:
+            self._counters = counters
 
 
     def _notify_some_waiting(self):
-        self._waiting.notify(self._can_start())
+        while self._idle and self._can_start():
+            waiter = self._idle.popleft()
+            waiter.job = self._job_take()
+            waiter.event.set()
 
 
-USAGE = 'usage: {} <command> <jobs-dir> [file-pattern]'
+USAGE = 'usage: {} [--server] [--poll] <command> <jobs-dir> [file-pattern]'
 
 
 def main():
-    if len(sys.argv) == 4:
-        cmd, jobs_dir, pattern = sys.argv[1:]
-    elif len(sys.argv) == 3:
-        cmd, jobs_dir = sys.argv[1:]
+    args = sys.argv[1:]
+    server = poll = False
+    while args[:1] in (['--server'], ['--poll']):
+        if args[0] == '--server':
+            server = True
+        else:
+            poll = True
+        args = args[1:]
+
+    if len(args) == 3:
+        cmd, jobs_dir, pattern = args
+    elif len(args) == 2:
+        cmd, jobs_dir = args
         pattern = '*'
     else:
         print(USAGE.format(sys.argv[0]), file=sys.stderr)
@@ -252,7 +442,7 @@ def main():
 
     log_path = os.path.join(jobs_dir, '.' + os.path.basename(cmd_path) + '.log')
 
-    runner = Runner(cmd_path, jobs_dir, pattern, log_path)
+    runner = Runner(cmd_path, jobs_dir, pattern, log_path, server, poll)
 
     try:
         runner.load_log()